@@ -40,6 +40,20 @@ resource "aws_iam_role_policy" "lambda_policy" {
         ]
         Resource = "${aws_s3_bucket.ses_emails.arn}/*"
       },
+      {
+        Effect = "Allow"
+        Action = [
+          "s3:PutObject"
+        ]
+        Resource = "${aws_s3_bucket.ses_emails.arn}/cache/*"
+      },
+      {
+        Effect = "Allow"
+        Action = [
+          "s3:ListBucket"
+        ]
+        Resource = aws_s3_bucket.ses_emails.arn
+      },
       {
         Effect = "Allow"
         Action = [
@@ -54,7 +68,8 @@ resource "aws_iam_role_policy" "lambda_policy" {
         Effect = "Allow"
         Action = [
           "ses:SendEmail",
-          "ses:SendRawEmail"
+          "ses:SendRawEmail",
+          "ses:GetSendQuota"
         ]
         Resource = "*"
       }
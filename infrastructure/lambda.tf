@@ -3,7 +3,7 @@ data "archive_file" "lambda_zip" {
   type        = "zip"
   source_dir  = "../processor"
   output_path = local.lambda_zip_path
-  excludes    = ["__pycache__", "*.pyc", ".git", "README.md", "test_local.py", ".env", ".env.example"]
+  excludes    = ["__pycache__", "*.pyc", ".git", "README.md", "test_local.py", ".env", ".env.example", "results.ndjson"]
 }
 
 # Lambda function
@@ -23,6 +23,7 @@ resource "aws_lambda_function" "invoice_parser" {
       S3_BUCKET   = aws_s3_bucket.ses_emails.bucket
       FROM_EMAIL      = var.email_address
       RESULT_EMAIL    = var.result_email_address
+      INVOICE_CACHE_BUCKET = aws_s3_bucket.ses_emails.bucket
     }
   }
 
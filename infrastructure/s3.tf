@@ -39,6 +39,24 @@ resource "aws_s3_bucket_lifecycle_configuration" "ses_emails" {
       days = 30
     }
   }
+
+  rule {
+    id     = "delete_old_invoice_cache"
+    status = "Enabled"
+
+    filter {
+      prefix = "cache/"
+    }
+
+    # Parsed invoices hold the same personal data as the emails; keep them no longer
+    expiration {
+      days = 30
+    }
+
+    noncurrent_version_expiration {
+      noncurrent_days = 1
+    }
+  }
 }
 
 # S3 bucket policy to allow SES to write emails
@@ -1,6 +1,10 @@
+import codecs
 import email
+import functools
+import io
 import json
 import logging
+from email.generator import BytesGenerator
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.application import MIMEApplication
@@ -8,8 +12,55 @@ from typing import List, Tuple, Dict, Any
 import os
 from botocore.exceptions import ClientError
 
+from throttling import retry_throttle
+
 logger = logging.getLogger(__name__)
 
+@functools.lru_cache(maxsize=32)
+def lookup_codec(charset: str) -> codecs.CodecInfo:
+    """
+    Resolve a MIME charset to its codec once, falling back to UTF-8 for unknown charsets.
+    """
+    try:
+        return codecs.lookup(charset)
+    except LookupError:
+        logger.warning("Unknown charset '%s', decoding as utf-8", charset)
+        return codecs.lookup('utf-8')
+
+def may_be_pdf_filename(part: email.message.Message) -> bool:
+    """
+    Check the raw (undecoded) attachment filename for a .pdf extension.
+    
+    Encoded (RFC 2047/2231) names cannot be checked without decoding, so they always pass.
+    """
+    raw_filename = part.get_param('filename', header='content-disposition')
+    if raw_filename is None:
+        raw_filename = part.get_param('name', header='content-type')
+    if raw_filename is None:
+        return False
+    if isinstance(raw_filename, tuple) or '=?' in raw_filename:
+        return True
+    return raw_filename.strip().lower().endswith('.pdf')
+
+class InvoicePartsMessage(email.message.Message):
+    """
+    Message factory for the MIME parser that only retains payloads extract_parts can use.
+    
+    Text and PDF parts keep their body; images, office documents and other attachments
+    are dropped as soon as the parser finishes them, so they never stay in memory.
+    """
+    
+    def set_payload(self, payload, charset=None):
+        if isinstance(payload, str) and not self._is_invoice_part():
+            payload = ''
+        super().set_payload(payload, charset)
+    
+    def _is_invoice_part(self) -> bool:
+        content_type = self.get_content_type()
+        if self.get_content_maintype() == 'text' or content_type == 'application/pdf':
+            return True
+        return self.get_content_disposition() == 'attachment' and may_be_pdf_filename(self)
+
 class EmailProcessor:
     """
     Handles email processing for SES integration.
@@ -19,33 +70,72 @@ class EmailProcessor:
         self.ses_client = ses_client
         self.from_email = os.environ.get('FROM_EMAIL', 'invoice-bot@katechat.tech')
     
-    def extract_email_content(self, msg: email.message.EmailMessage) -> str:
+    def extract_parts(self, msg: email.message.EmailMessage) -> Tuple[str, List[Tuple[bytes, str]]]:
         """
-        Extract plain text content from email message.
+        Extract plain text content and PDF attachments in a single pass over the MIME tree.
         
         Returns:
-            Extracted email text content
+            Tuple (email_text, pdf_attachments), where pdf_attachments is a list of tuples
+            (pdf_data, filename)
         """
-        email_text = ""
+        text_chunks = []
+        pdf_attachments = []
+        is_multipart = msg.is_multipart()
         
         try:
-            if msg.is_multipart():
-                for part in msg.walk():
-                    content_type = part.get_content_type()
-                    content_disposition = str(part.get("Content-Disposition"))
-                    
-                    if content_type == "text/plain" and "attachment" not in content_disposition:
-                        charset = part.get_content_charset() or 'utf-8'
-                        email_text += part.get_payload(decode=True).decode(charset, errors='replace')
-            else:
-                charset = msg.get_content_charset() or 'utf-8'
-                email_text = msg.get_payload(decode=True).decode(charset, errors='replace')
+            for part in msg.walk():
+                if part.is_multipart():
+                    continue
+                
+                content_type = part.get_content_type()
+                content_disposition = part.get_content_disposition()
+                
+                # Classify the part first so skipped parts are never decoded
+                if content_disposition == 'attachment':
+                    # Cheap check on the raw parameter before decoding the filename
+                    if not may_be_pdf_filename(part):
+                        continue
+                    filename = part.get_filename()
+                    if not (filename and filename.lower().endswith('.pdf')):
+                        continue
+                    kind = 'PDF attachment'
+                elif content_type == 'application/pdf':
+                    filename = part.get_filename() or 'invoice.pdf'
+                    kind = 'inline PDF'
+                # Single-part messages are treated as text whatever their type
+                elif content_type == 'text/plain' or not is_multipart:
+                    filename = None
+                    kind = 'text'
+                else:
+                    continue
+                
+                # Decode the transfer encoding exactly once per kept part
+                payload = part.get_payload(decode=True)
+                if not payload:
+                    continue
+                
+                if kind == 'text':
+                    codec = lookup_codec(part.get_content_charset() or 'utf-8')
+                    text_chunks.append(codec.decode(payload, 'replace')[0])
+                else:
+                    pdf_attachments.append((payload, filename))
+                    logger.info("Found %s: %s", kind, filename)
         
         except Exception as e:
-            logger.error(f"Error extracting email content: {str(e)}")
+            logger.error("Error extracting email parts: %s", e)
             raise
         
-        return email_text.strip()
+        return "".join(text_chunks).strip(), pdf_attachments
+    
+    def extract_email_content(self, msg: email.message.EmailMessage) -> str:
+        """
+        Extract plain text content from email message.
+        
+        Returns:
+            Extracted email text content
+        """
+        email_text, _ = self.extract_parts(msg)
+        return email_text
     
     def extract_pdf_attachments(self, msg: email.message.EmailMessage) -> List[Tuple[bytes, str]]:
         """
@@ -54,32 +144,7 @@ class EmailProcessor:
         Returns:
             List of tuples (pdf_data, filename)
         """
-        pdf_attachments = []
-        
-        try:
-            for part in msg.walk():
-                # Check if this part is an attachment
-                if part.get_content_disposition() == 'attachment':
-                    filename = part.get_filename()
-                    
-                    if filename and filename.lower().endswith('.pdf'):
-                        pdf_data = part.get_payload(decode=True)
-                        if pdf_data:
-                            pdf_attachments.append((pdf_data, filename))
-                            logger.info(f"Found PDF attachment: {filename}")
-                
-                # Also check for inline PDFs
-                elif part.get_content_type() == 'application/pdf':
-                    filename = part.get_filename() or 'invoice.pdf'
-                    pdf_data = part.get_payload(decode=True)
-                    if pdf_data:
-                        pdf_attachments.append((pdf_data, filename))
-                        logger.info(f"Found inline PDF: {filename}")
-        
-        except Exception as e:
-            logger.error(f"Error extracting PDF attachments: {str(e)}")
-            raise
-        
+        _, pdf_attachments = self.extract_parts(msg)
         return pdf_attachments
     
     def send_results_email(self, to_email: str, results: List[Dict[str, Any]], 
@@ -120,19 +185,20 @@ class EmailProcessor:
             msg.attach(json_attachment)
         
             # Send email
-            self.ses_client.send_raw_email(
+            retry_throttle(
+                self.ses_client.send_raw_email,
                 Source=self.from_email,
                 Destinations=[to_email],
-                RawMessage={'Data': msg.as_string()}
+                RawMessage={'Data': self._serialize_message(msg)}
             )
             
-            logger.info(f"Successfully sent results email to {to_email}")
+            logger.info("Successfully sent results email to %s", to_email)
             
         except ClientError as e:
-            logger.error(f"Error sending email via SES: {str(e)}")
+            logger.error("Error sending email via SES: %s", e)
             raise
         except Exception as e:
-            logger.error(f"Error creating/sending email: {str(e)}")
+            logger.error("Error creating/sending email: %s", e)
             raise
     
     def send_error_email(self, to_email: str, error_message: str):
@@ -154,64 +220,73 @@ class EmailProcessor:
             msg.attach(MIMEText(error_message, 'plain', 'utf-8'))
             
             # Send email
-            self.ses_client.send_raw_email(
+            retry_throttle(
+                self.ses_client.send_raw_email,
                 Source=self.from_email,
                 Destinations=[to_email],
-                RawMessage={'Data': msg.as_string()}
+                RawMessage={'Data': self._serialize_message(msg)}
             )
             
-            logger.info(f"Successfully sent error notification email to {to_email}")
+            logger.info("Successfully sent error notification email to %s", to_email)
             
         except ClientError as e:
-            logger.error(f"Error sending error email via SES: {str(e)}")
+            logger.error("Error sending error email via SES: %s", e)
             raise
         except Exception as e:
-            logger.error(f"Error creating/sending error email: {str(e)}")
+            logger.error("Error creating/sending error email: %s", e)
             raise
     
+    def _serialize_message(self, msg: MIMEMultipart) -> bytes:
+        """
+        Serialize a MIME message straight to bytes for SES, without an intermediate str copy.
+        """
+        buffer = io.BytesIO()
+        BytesGenerator(buffer, mangle_from_=False).flatten(msg)
+        return buffer.getvalue()
+    
     def _create_email_body(self, results: List[Dict[str, Any]], sender_email: str = None) -> str:
         """
         Create the email body text with processing results.
         """
-        body = "Hello,\n\n"
+        parts = ["Hello,\n\n"]
         if sender_email:
-            body += f"Invoice processing complete for email from: {sender_email}\n\n"
+            parts.append(f"Invoice processing complete for email from: {sender_email}\n\n")
         else:
-            body += "Invoice processing complete. Please find the results below:\n\n"
+            parts.append("Invoice processing complete. Please find the results below:\n\n")
         
         for i, result in enumerate(results):
             parsed_data = result or dict()
             error = result['error'] if 'error' in result else None
             filename = result.get('filename', 'unknown.pdf')
             
-            body += f"## Invoice {i}: {filename}\n"
+            parts.append(f"## Invoice {i}: {filename}\n")
             if error:
-                body += f"Processing error: {error}\n\n"
+                parts.append(f"Processing error: {error}\n\n")
                 continue
             
-            body += f"Invoice Number: {parsed_data.get('invoice_number', 'N/A')}\n"
-            body += f"Issuer: {parsed_data.get('issuer_name', 'N/A')}\n"
-            body += f"Receiver: {parsed_data.get('receiver_name', 'N/A')}\n"
-            body += f"Total: {parsed_data.get('total', 0)}\n"
+            parts.append(f"Invoice Number: {parsed_data.get('invoice_number', 'N/A')}\n")
+            parts.append(f"Issuer: {parsed_data.get('issuer_name', 'N/A')}\n")
+            parts.append(f"Receiver: {parsed_data.get('receiver_name', 'N/A')}\n")
+            parts.append(f"Total: {parsed_data.get('total', 0)}\n")
             
             items = parsed_data.get('items', [])
             if items:
-                body += f"Items ({len(items)}):\n"
+                parts.append(f"Items ({len(items)}):\n")
                 for item in items:
                     title = item.get('title', 'N/A')
                     quantity = item.get('quantity', 'N/A')
                     price = item.get('price', 0)
-                    body += f"    - {title} (Qty: {quantity}, Price: {price})\n"
+                    parts.append(f"    - {title} (Qty: {quantity}, Price: {price})\n")
             else:
-                body += "Items: None found\n"
+                parts.append("Items: None found\n")
             
-            body += "\n"
+            parts.append("\n")
         
-        body += "Attachments included:\n"
-        body += "- Original PDF files\n"
-        body += "- Parsed invoices JSON data\n\n"
-        body += "Best regards,\n"
-        body += "Invoice Processing Bot\n"
-        body += "katechat.tech"
+        parts.append("Attachments included:\n")
+        parts.append("- Original PDF files\n")
+        parts.append("- Parsed invoices JSON data\n\n")
+        parts.append("Best regards,\n")
+        parts.append("Invoice Processing Bot\n")
+        parts.append("katechat.tech")
         
-        return body
\ No newline at end of file
+        return "".join(parts)
\ No newline at end of file
@@ -0,0 +1,59 @@
+import hashlib
+import json
+import logging
+from typing import Dict, Any, List, Optional
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger(__name__)
+
+
+class S3InvoiceCache:
+    """
+    Content-addressed cache of parsed invoices stored as JSON objects in S3.
+
+    Entries are keyed by the SHA-256 of the PDF bytes, so resent or forwarded
+    invoices are served without another Bedrock call.
+    """
+
+    def __init__(self, s3_client, bucket_name: str, prefix: str = "cache/"):
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+
+    def key_for(self, pdf_bytes: bytes, namespace: str) -> str:
+        """
+        Build the S3 key for a PDF; namespace (e.g. model id and prompt hash) separates incompatible results.
+        """
+        digest = hashlib.sha256(pdf_bytes).hexdigest()
+        return f"{self.prefix}{namespace}/{digest}.json"
+
+    def get(self, pdf_bytes: bytes, namespace: str) -> Optional[List[Dict[str, Any]]]:
+        """
+        Return the cached invoices for a PDF, or None on a cache miss.
+        """
+        key = self.key_for(pdf_bytes, namespace)
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket_name, Key=key)
+            return json.loads(response["Body"].read())
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") not in ("NoSuchKey", "404"):
+                logger.warning("Error reading invoice cache entry %s: %s", key, e)
+            return None
+        except Exception as e:
+            logger.warning("Invalid invoice cache entry %s: %s", key, e)
+            return None
+
+    def put(self, pdf_bytes: bytes, namespace: str, invoices: List[Dict[str, Any]]):
+        """
+        Store the parsed invoices for a PDF. Failures are logged and ignored.
+        """
+        key = self.key_for(pdf_bytes, namespace)
+        try:
+            self.s3_client.put_object(
+                Bucket=self.bucket_name,
+                Key=key,
+                Body=json.dumps(invoices, ensure_ascii=False).encode("utf-8"),
+                ContentType="application/json",
+            )
+        except Exception as e:
+            logger.warning("Error writing invoice cache entry %s: %s", key, e)
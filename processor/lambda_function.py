@@ -1,26 +1,27 @@
+import functools
 import json
-import base64
 import boto3
 import logging
 import email
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.mime.application import MIMEApplication
-from botocore.exceptions import ClientError
+from email import policy
+from email.parser import BytesFeedParser
+from botocore.config import Config
 import os
-from typing import Dict, List, Any, Optional
-import tempfile
+import threading
+from typing import Dict, Any, Optional
 
-# Load environment variables from .env file (for local development)
-try:
-    from dotenv import load_dotenv
-    load_dotenv()
-except ImportError:
-    # dotenv not available (e.g., in Lambda), use environment variables directly
-    pass
+# Load environment variables from .env file (for local development only)
+if os.environ.get('AWS_LAMBDA_FUNCTION_NAME') is None:
+    try:
+        from dotenv import load_dotenv
+        load_dotenv()
+    except ImportError:
+        # dotenv not installed, use environment variables directly
+        pass
 
 from pdf_parser import PDFParser
-from email_processor import EmailProcessor
+from invoice_cache import S3InvoiceCache
+from email_processor import EmailProcessor, InvoicePartsMessage
 
 # Configure logging
 logger = logging.getLogger()
@@ -28,16 +29,33 @@ log_level = os.environ.get('LOG_LEVEL', 'INFO').upper()
 logger.setLevel(getattr(logging, log_level, logging.INFO))
 
 RESULT_EMAIL = os.environ.get('RESULT_EMAIL')
+EMAIL_READ_CHUNK_SIZE = 64 * 1024
 
 # Get AWS configuration from environment variables
 # aws_region = os.environ.get('AWS_REGION', 'eu-central-1')
 # aws_access_key_id = os.environ.get('AWS_ACCESS_KEY_ID')
 # aws_secret_access_key = os.environ.get('AWS_SECRET_ACCESS_KEY')
 
+# Larger keep-alive connection pool so concurrent Bedrock/SES calls reuse TLS sessions
+boto_config = Config(
+    max_pool_connections=int(os.environ.get('BOTO_POOL', '32')),
+    tcp_keepalive=True,
+    retries={'mode': 'standard', 'max_attempts': 3},
+    connect_timeout=3,
+    read_timeout=60,
+)
+
+# Bedrock and SES calls are retried by throttling.retry_throttle, outside the Bedrock rate
+# limiter; botocore retries are disabled for them so a call is not retried at two layers
+RETRY_THROTTLE_SERVICES = {'bedrock-runtime', 'ses'}
+single_attempt_config = boto_config.merge(Config(retries={'mode': 'standard', 'total_max_attempts': 1}))
+
 # Initialize AWS clients with explicit credentials if provided
+# Clients are cached so repeated calls reuse the same client and its connection pool
+@functools.lru_cache(maxsize=8)
 def create_boto3_client(service_name, region_name=None):
     """Create boto3 client with environment credentials if available."""
-    kwargs = {}
+    kwargs = {'config': single_attempt_config if service_name in RETRY_THROTTLE_SERVICES else boto_config}
     # if region_name:
     #     kwargs['region_name'] = region_name
     # if aws_access_key_id and aws_secret_access_key:
@@ -49,6 +67,22 @@ bedrock_client = create_boto3_client('bedrock-runtime')
 ses_client = create_boto3_client('ses')
 s3_client = create_boto3_client('s3')
 
+def prewarm_ses_connection():
+    """
+    Open the SES connection with a cheap call so the first send skips the TLS handshake.
+    """
+    try:
+        ses_client.get_send_quota()
+    except Exception as e:
+        logger.debug("SES connection prewarm failed: %s", e)
+
+# Optional content-hash cache of parsed invoices
+INVOICE_CACHE_BUCKET = os.environ.get('INVOICE_CACHE_BUCKET')
+invoice_cache = S3InvoiceCache(s3_client, INVOICE_CACHE_BUCKET) if INVOICE_CACHE_BUCKET else None
+
+# Prime the connection pool in the background during cold start
+threading.Thread(target=prewarm_ses_connection, daemon=True).start()
+
 def extract_sender_email(mail_obj: Dict[str, Any]) -> Optional[str]:
     """
     Extract sender email from SES mail object.
@@ -60,7 +94,7 @@ def extract_sender_email(mail_obj: Dict[str, Any]) -> Optional[str]:
             return mail_obj['source']
         return None
     except Exception as e:
-        logger.error(f"Error extracting sender email: {str(e)}")
+        logger.error("Error extracting sender email: %s", e)
         return None
 
 def format_error_email_body(error_message: str):
@@ -94,16 +128,20 @@ def lambda_handler(event, context):
     Main Lambda handler for processing SES emails with PDF attachments.
     """
     
-    # Initialize AWS clients
-    bedrock_client = create_boto3_client('bedrock-runtime')
-    ses_client = create_boto3_client('ses')
-    
-    # Initialize processors
-    pdf_parser = PDFParser(bedrock_client)
+    # Initialize processors with the module-level clients reused across warm invocations
+    pdf_parser = PDFParser(bedrock_client, cache=invoice_cache)
     email_processor = EmailProcessor(ses_client)
     
     try:
-        logger.info(f"Received event: {json.dumps(event, default=str)}")
+        records = event.get('Records', [])
+        logger.info(
+            "Received SES event: records=%d messageId=%s",
+            len(records),
+            records[0].get('ses', {}).get('mail', {}).get('messageId', '?') if records else '?',
+        )
+        # The full event can be large; only serialize it when debugging
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Received event: %s", json.dumps(event, default=str))
         
         # Process SES event
         results = []
@@ -112,7 +150,13 @@ def lambda_handler(event, context):
                 if record.get('eventSource') == 'aws:ses':
                     result = process_ses_mail(record, pdf_parser, email_processor)
                     results.append(result)
-                    logger.info(f"Processed SES record: {json.dumps(result, default=str)}")
+                    logger.info(
+                        "Processed SES record: messageId=%s statusCode=%s",
+                        result.get('messageId'),
+                        result.get('statusCode'),
+                    )
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug("Processed SES record result: %s", json.dumps(result, default=str))
         
         return {
             'statusCode': 200,
@@ -139,7 +183,7 @@ def lambda_handler(event, context):
                 logger.warning("RESULT_EMAIL not configured; cannot send error notification.")
                 
         except Exception as notification_error:
-            logger.error(f"Failed to send error notification: {str(notification_error)}")
+            logger.error("Failed to send error notification: %s", notification_error)
         
         return {
             'statusCode': 500,
@@ -161,7 +205,7 @@ def get_s3_email_details(record: Dict[str, Any]) -> tuple[Optional[str], Optiona
         if action.get('type') == 's3':
             bucket_name = action.get('bucketName')
             object_key = action.get('objectKey')
-            logger.info(f"Found S3 details: bucket={bucket_name}, key={object_key}")
+            logger.info("Found S3 details: bucket=%s, key=%s", bucket_name, object_key)
             return bucket_name, object_key
         
         # Fallback: try to construct from message ID (common SES pattern)
@@ -169,14 +213,14 @@ def get_s3_email_details(record: Dict[str, Any]) -> tuple[Optional[str], Optiona
         if message_id:
             # This is a common pattern - you might need to adjust based on your SES rule configuration
             inferred_key = f"emails/{message_id}"
-            logger.info(f"Using inferred S3 key: {inferred_key}")
+            logger.info("Using inferred S3 key: %s", inferred_key)
             return None, inferred_key  # Bucket will be determined from environment
         
         logger.warning("Could not extract S3 details from SES record")
         return None, None
         
     except Exception as e:
-        logger.error(f"Error extracting S3 details: {str(e)}")
+        logger.error("Error extracting S3 details: %s", e)
         return None, None
 
 def download_email_from_s3(bucket_name: str, object_key: str) -> Optional[email.message.EmailMessage]:
@@ -192,22 +236,23 @@ def download_email_from_s3(bucket_name: str, object_key: str) -> Optional[email.
             bucket_name = os.environ.get('S3_BUCKET')
             if not bucket_name:
                 raise ValueError("S3_BUCKET environment variable not set and no bucket name in SES record")
-            logger.info(f"Using S3 bucket from environment: {bucket_name}")
+            logger.info("Using S3 bucket from environment: %s", bucket_name)
         
-        logger.info(f"Downloading email from S3: s3://{bucket_name}/{object_key}")
+        logger.info("Downloading email from S3: s3://%s/%s", bucket_name, object_key)
         
-        # Download the email content
+        # Feed the raw email to the parser chunk by chunk as it streams from S3;
+        # bodies of parts we never use (images, other attachments) are discarded while parsing
         response = s3.get_object(Bucket=bucket_name, Key=object_key)
-        email_content = response['Body'].read().decode('utf-8')
-        
-        # Parse the email
-        email_message = email.message_from_string(email_content)
+        parser = BytesFeedParser(_factory=InvoicePartsMessage, policy=policy.compat32)
+        for chunk in response['Body'].iter_chunks(EMAIL_READ_CHUNK_SIZE):
+            parser.feed(chunk)
+        email_message = parser.close()
         logger.info("Successfully parsed email from S3")
         
         return email_message
         
     except Exception as e:
-        logger.error(f"Error downloading email from S3: {str(e)}")
+        logger.error("Error downloading email from S3: %s", e)
         return None
 
 def process_ses_mail(record: Dict[str, Any], pdf_parser: PDFParser, email_processor: EmailProcessor) -> Dict[str, Any]:
@@ -225,7 +270,7 @@ def process_ses_mail(record: Dict[str, Any], pdf_parser: PDFParser, email_proces
         source = mail_obj.get('source', sender_email or 'unknown')
         destination = mail_obj.get('destination', [])
         
-        logger.info(f"Processing email from {source} to {destination}")
+        logger.info("Processing email from %s to %s", source, destination)
         
         # Extract S3 information for the email content
         common_headers = mail_obj.get('commonHeaders', {})
@@ -237,7 +282,7 @@ def process_ses_mail(record: Dict[str, Any], pdf_parser: PDFParser, email_proces
         if not object_key:
             # If we can't find S3 details, try to use the message ID as key
             object_key = message_id
-            logger.info(f"Using message ID as S3 key: {object_key}")
+            logger.info("Using message ID as S3 key: %s", object_key)
         
         # Download and parse the email from S3
         email_message = download_email_from_s3(bucket_name, object_key)
@@ -253,9 +298,10 @@ def process_ses_mail(record: Dict[str, Any], pdf_parser: PDFParser, email_proces
                 'messageId': message_id
             }
         
-        # Extract PDF attachments
-        pdf_attachments = email_processor.extract_pdf_attachments(email_message)
-        email_text = email_processor.extract_email_content(email_message)
+        # Extract email text and PDF attachments in one pass
+        email_text, pdf_attachments = email_processor.extract_parts(email_message)
+        # Release the rest of the MIME tree (inline images, HTML, ...) while Bedrock runs
+        del email_message
         
         if not pdf_attachments and not email_text:
             # No PDFs found - send informational email
@@ -270,7 +316,7 @@ def process_ses_mail(record: Dict[str, Any], pdf_parser: PDFParser, email_proces
                 'processed_attachments': 0
             }
         
-        logger.info(f"Found {len(pdf_attachments)} PDF attachments")
+        logger.info("Found %d PDF attachments", len(pdf_attachments))
         
         # Process each PDF attachment
         results = []
@@ -278,7 +324,7 @@ def process_ses_mail(record: Dict[str, Any], pdf_parser: PDFParser, email_proces
             results = pdf_parser.parse_invoice(pdf_attachments, email_text)
             
         except Exception as pdf_error:
-            logger.error(f"Error parsing email: {str(pdf_error)}")
+            logger.error("Error parsing email: %s", pdf_error)
             results.append({
                 'error': str(pdf_error),
                 'parsed_data': dict(),
@@ -294,9 +340,9 @@ def process_ses_mail(record: Dict[str, Any], pdf_parser: PDFParser, email_proces
                     original_pdfs=pdf_attachments,
                     sender_email=sender_email  # Include sender info for context
                 )
-                logger.info(f"Sent results email to {RESULT_EMAIL} (from {sender_email})")
+                logger.info("Sent results email to %s (from %s)", RESULT_EMAIL, sender_email)
             except Exception as email_error:
-                logger.error(f"Failed to send results email: {str(email_error)}")
+                logger.error("Failed to send results email: %s", email_error)
                 # Still continue - we processed the PDFs successfully
         
         return {
@@ -1,57 +1,53 @@
+import hashlib
 import json
 import logging
-import base64
 import os
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, Any, List, Optional, Tuple
 from botocore.exceptions import ClientError
 
-logger = logging.getLogger(__name__)
-
-
-class PDFParser:
-    """
-    PDF parser using AWS Bedrock Nova model for invoice extraction.
-    """
-
-    def __init__(self, bedrock_client):
-        self.bedrock_client = bedrock_client
-        self.model_id = "eu.amazon.nova-lite-v1:0"  # Nova Lite model
-
-    def parse_invoice(
-        self, pdf_data: List[Tuple[bytes, str]], email_content: str | None
-    ) -> Dict[str, Any]:
-        """
-        Parse invoice PDF using AWS Bedrock Nova model with direct PDF input.
-        """
-
-        try:
-            logger.info(
-                f"Processing {len(pdf_data)} PDF(s) of {sum(len(b) for b, _ in pdf_data)} bytes"
-            )
+from throttling import RateLimiter, retry_throttle
 
-            # Bedrock supports only 5 documents per request
-            pdf_batches = [pdf_data[i:i + 5] for i in range(0, len(pdf_data), 5)]
-            results = []
-            
-            for batch in pdf_batches:
-                # Call Bedrock Nova model with PDF
-                response = self._extract_json(batch, email_content)
-                # Parse and validate response
-                parsed_data = self._parse_json_response(response)
-                if parsed_data:
-                    results.extend(parsed_data)
-
-            return results
-
-        except Exception as e:
-            logger.error(f"Error parsing PDF: {str(e)}")
-            raise
+logger = logging.getLogger(__name__)
 
-    def _create_invoice_parsing_prompt(self, email_content: str) -> str:
-        """
-        Create a detailed prompt for the Nova model to parse invoice data from PDF.
-        """
-        return """
+# Keep concurrent batches within the Bedrock account quota
+BEDROCK_MAX_INFLIGHT = int(os.environ.get("BEDROCK_MAX_INFLIGHT", "4"))
+BEDROCK_RPS = float(os.environ.get("BEDROCK_RPS", "5"))
+bedrock_limiter = RateLimiter(BEDROCK_MAX_INFLIGHT, BEDROCK_RPS)
+
+# Shared pool for Bedrock batch calls, reused across warm Lambda invocations; sized to the
+# in-flight limit by default, since extra workers would only wait on the limiter
+PDF_PARSE_CONCURRENCY = int(os.environ.get("PDF_PARSE_CONCURRENCY", BEDROCK_MAX_INFLIGHT))
+pdf_parse_executor = ThreadPoolExecutor(max_workers=PDF_PARSE_CONCURRENCY)
+
+# Explicit output budget so a batch of up to 5 invoices is not truncated mid-JSON
+BEDROCK_MAX_TOKENS = int(os.environ.get("BEDROCK_MAX_TOKENS", "4096"))
+
+JSON_DECODER = json.JSONDecoder()
+
+# Defaults for required fields missing from the model output ("items" gets a fresh list per invoice)
+INVOICE_FIELD_DEFAULTS = (
+    ("invoice_number", ""),
+    ("receiver_name", ""),
+    ("receiver_address", ""),
+    ("issuer_name", ""),
+    ("issuer_address", ""),
+    ("total", 0),
+)
+ITEM_FIELD_DEFAULTS = (
+    ("title", ""),
+    ("quantity", ""),
+    ("price", 0),
+)
+
+# Email bodies sent alongside PDFs are trimmed to their head and tail (totals/signatures sit at the end)
+EMAIL_CONTENT_MAX_CHARS = 2000
+EMAIL_CONTENT_HEAD_CHARS = 1000
+EMAIL_CONTENT_TAIL_CHARS = 500
+
+# Static part of the Bedrock prompt; only the email content is appended per call
+INVOICE_PARSING_PROMPT = """
 You are an expert invoice parser. Please analyze the PDF document and email text and extract the required information in a strict JSON format.
 
 The PDF and email may contain an invoice in English or German. Please extract the following information and return ONLY a valid array of JSON objects with this exact structure:
@@ -84,12 +80,188 @@ IMPORTANT INSTRUCTIONS:
 7. For addresses, include the complete address with street, city, postal code if available
 8. For quantities, extract the actual number (e.g., "2x" becomes "2")
 9. Look carefully at the document structure to identify invoice details, line items, and totals
+10. Output compact JSON on a single line, with no indentation or extra whitespace
 
 Remember: Return ONLY the JSON object, nothing else.
 
 EMAIL CONTENT:
 
-""" + (email_content or "N/A")
+"""
+
+# Identifies the prompt in invoice cache keys so a prompt change does not serve stale results
+PROMPT_HASH = hashlib.sha256(INVOICE_PARSING_PROMPT.encode("utf-8")).hexdigest()[:12]
+
+
+class _FilenameTranslation(dict):
+    """
+    str.translate table for _sanitize_filename; each character is classified once and memoized.
+    """
+
+    ALLOWED = frozenset(" -_][()")
+
+    def __missing__(self, codepoint: int) -> int:
+        char = chr(codepoint)
+        value = codepoint if char.isalnum() or char in self.ALLOWED else ord("_")
+        self[codepoint] = value
+        return value
+
+
+FILENAME_TRANSLATION = _FilenameTranslation()
+
+
+class PDFParser:
+    """
+    PDF parser using AWS Bedrock Nova model for invoice extraction.
+    """
+
+    def __init__(self, bedrock_client, cache=None):
+        self.bedrock_client = bedrock_client
+        self.model_id = "eu.amazon.nova-lite-v1:0"  # Nova Lite model
+        self.cache = cache  # Optional S3InvoiceCache keyed by PDF content hash
+        self.cache_namespace = f"{self.model_id}/{PROMPT_HASH}"
+
+    def parse_invoice(
+        self, pdf_data: List[Tuple[bytes, str]], email_content: str | None
+    ) -> Dict[str, Any]:
+        """
+        Parse invoice PDF using AWS Bedrock Nova model with direct PDF input.
+        """
+
+        try:
+            # Empty attachments cannot be parsed; skip Bedrock entirely when nothing is left
+            pdf_data = [pdf for pdf in pdf_data if pdf[0]]
+            if not pdf_data:
+                logger.info("No PDF data to parse")
+                return []
+
+            logger.info(
+                "Processing %d PDF(s) of %d bytes",
+                len(pdf_data),
+                sum(len(b) for b, _ in pdf_data),
+            )
+
+            results = []
+
+            # With PDFs attached the email body is mostly context; keep the prompt short
+            email_content = self._trim_email_content(email_content)
+
+            # Serve previously parsed PDFs from the cache and only send misses to Bedrock
+            if self.cache:
+                results, pdf_data = self._split_cached(pdf_data)
+
+            # Bedrock supports only 5 documents per request
+            pdf_batches = [pdf_data[i:i + 5] for i in range(0, len(pdf_data), 5)]
+
+            # Bedrock calls are network-bound, so run the batches concurrently
+            futures = [
+                pdf_parse_executor.submit(self._parse_batch, batch, email_content)
+                for batch in pdf_batches
+            ]
+
+            for batch, future in zip(pdf_batches, futures):
+                try:
+                    parsed_data = future.result()
+                except Exception as e:
+                    # Report the failed batch per file instead of aborting the whole email
+                    logger.error("Error parsing PDF batch: %s", e)
+                    results.extend(
+                        {"filename": filename, "error": str(e)} for _, filename in batch
+                    )
+                    continue
+
+                if parsed_data:
+                    results.extend(parsed_data)
+
+            return results
+
+        except Exception as e:
+            logger.error("Error parsing PDF: %s", e)
+            raise
+
+    def _parse_batch(
+        self, pdf_data: List[Tuple[bytes, str]], email_content: str | None
+    ) -> List[Dict[str, Any]]:
+        """
+        Parse a single batch of up to 5 PDFs with one Bedrock call.
+        """
+        # Call Bedrock Nova model with PDF
+        response = self._extract_json(pdf_data, email_content)
+        # Parse and validate response
+        parsed_data = self._parse_json_response(response)
+        if self.cache:
+            self._store_cached(pdf_data, parsed_data)
+        return parsed_data
+
+    def _split_cached(
+        self, pdf_data: List[Tuple[bytes, str]]
+    ) -> Tuple[List[Dict[str, Any]], List[Tuple[bytes, str]]]:
+        """
+        Look up PDFs in the cache and return (cached invoices, PDFs still to parse).
+        """
+        cached_results = []
+        misses = []
+        entries = pdf_parse_executor.map(
+            lambda pdf: self.cache.get(pdf[0], self.cache_namespace), pdf_data
+        )
+
+        for pdf, invoices in zip(pdf_data, entries):
+            if invoices is None:
+                misses.append(pdf)
+                continue
+            filename = pdf[1]
+            logger.info("Using cached invoice data for %s", filename)
+            cached_results.extend(dict(invoice, filename=filename) for invoice in invoices)
+
+        return cached_results, misses
+
+    def _store_cached(
+        self, pdf_data: List[Tuple[bytes, str]], parsed_data: List[Dict[str, Any]]
+    ):
+        """
+        Cache the invoices parsed from each PDF of a batch.
+
+        Invoices are matched to their PDF by filename; a single-PDF batch owns every
+        attachment invoice. PDFs sharing a filename with another PDF of the batch (e.g.
+        unnamed inline parts) cannot be told apart and are not cached. Invoices found in
+        the email body are never cached.
+        """
+        name_counts = Counter(self._sanitize_filename(filename) for _, filename in pdf_data)
+        for pdf_bytes, filename in pdf_data:
+            if name_counts[self._sanitize_filename(filename)] > 1:
+                continue
+            names = {filename, self._sanitize_filename(filename)}
+            invoices = [
+                invoice
+                for invoice in parsed_data
+                if invoice.get("source") != "email_body"
+                and (len(pdf_data) == 1 or invoice.get("filename") in names)
+            ]
+            if invoices:
+                self.cache.put(pdf_bytes, self.cache_namespace, invoices)
+
+    def _trim_email_content(self, email_content: str | None) -> str | None:
+        """
+        Keep only the head and tail of a long email body to save prompt tokens.
+        """
+        if not email_content or len(email_content) <= EMAIL_CONTENT_MAX_CHARS:
+            return email_content
+
+        logger.info(
+            "Trimming email content from %d to %d characters",
+            len(email_content),
+            EMAIL_CONTENT_HEAD_CHARS + EMAIL_CONTENT_TAIL_CHARS,
+        )
+        return (
+            email_content[:EMAIL_CONTENT_HEAD_CHARS]
+            + "\n[...]\n"
+            + email_content[-EMAIL_CONTENT_TAIL_CHARS:]
+        )
+
+    def _create_invoice_parsing_prompt(self, email_content: str) -> str:
+        """
+        Create a detailed prompt for the Nova model to parse invoice data from PDF.
+        """
+        return INVOICE_PARSING_PROMPT + (email_content or "N/A")
 
     def _extract_json(
         self, pdf_data: List[Tuple[bytes, str]], email_content: str | None
@@ -115,15 +287,15 @@ EMAIL CONTENT:
             # Prepare the request body for Nova model with PDF document
             request_body = {
                 "messages": [{"role": "user", "content": [{"text": prompt}, *pdfs]}],
-                "inferenceConfig": {"temperature": 0, "topP": 0.75},
+                "inferenceConfig": {
+                    "temperature": 0,
+                    "topP": 0.75,
+                    "maxTokens": BEDROCK_MAX_TOKENS,
+                },
             }
 
-            # Call the model
-            response = self.bedrock_client.converse(
-                modelId=self.model_id,
-                messages=request_body["messages"],
-                inferenceConfig=request_body["inferenceConfig"],
-            )
+            # Call the model, backing off if Bedrock throttles us
+            response = retry_throttle(self._converse, request_body)
 
             # Extract the response text
             response_text = response["output"]["message"]["content"][0]["text"]
@@ -131,70 +303,58 @@ EMAIL CONTENT:
             return response_text
 
         except ClientError as e:
-            logger.error(f"Error calling '{self.model_id}': {str(e)}")
+            logger.error("Error calling '%s': %s", self.model_id, e)
             raise
         except Exception as e:
-            logger.error(f"Unexpected error calling '{self.model_id}': {str(e)}")
+            logger.error("Unexpected error calling '%s': %s", self.model_id, e)
             raise
 
+    def _converse(self, request_body: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Send a single rate-limited Converse request to Bedrock.
+        """
+        with bedrock_limiter:
+            return self.bedrock_client.converse(
+                modelId=self.model_id,
+                messages=request_body["messages"],
+                inferenceConfig=request_body["inferenceConfig"],
+            )
+
     def _sanitize_filename(self, filename: str) -> str:
         """
         Sanitize filename to remove any unwanted characters.
         """
-        return "".join(c if c.isalnum() or c in (' ', '-', '_', ']', '[', '(', ')') else '_' for c in filename).rstrip()
+        return filename.translate(FILENAME_TRANSLATION).rstrip()
     
     def _parse_json_response(self, response_text: str) -> List[Dict[str, Any]]:
         """
         Parse and validate the Nova model response.
         """
         try:
-            # Clean the response - sometimes models add extra text
-            response_text = response_text.strip()
-
-            # Find JSON in the response (in case there's extra text)
+            # Find JSON in the response (in case there's extra text around it)
             start_idx = response_text.find("[")
-            end_idx = response_text.rfind("]") + 1
 
-            if start_idx == -1 or end_idx == 0:
+            if start_idx == -1:
                 raise ValueError("No JSON found in response")
 
-            json_text = response_text[start_idx:end_idx]
-
-            # Parse JSON
-            parsed_data = json.loads(json_text)
-
-            # Validate required fields
-            required_fields = [
-                "invoice_number",
-                "receiver_name",
-                "receiver_address",
-                "issuer_name",
-                "issuer_address",
-                "total",
-                "items",
-            ]
+            # Parse JSON in place from the first "[" - no trailing scan or substring copy
+            parsed_data, _ = JSON_DECODER.raw_decode(response_text, start_idx)
 
+            # Fill in missing required fields with their defaults
             for i, invoice in enumerate(parsed_data):
-                for field in required_fields:
-                    if field not in invoice:
-                        invoice[field] = (
-                            ""
-                            if field != "total" and field != "items"
-                            else (0 if field == "total" else [])
-                        )
+                for field, default in INVOICE_FIELD_DEFAULTS:
+                    invoice.setdefault(field, default)
+
                 # Validate items structure
-                if not isinstance(invoice["items"], list):
-                    invoice["items"] = []
+                items = invoice.setdefault("items", [])
+                if not isinstance(items, list):
+                    invoice["items"] = items = []
 
-                for item in invoice["items"]:
+                for item in items:
                     if not isinstance(item, dict):
                         continue
-                    if "title" not in item:
-                        item["title"] = ""
-                    if "quantity" not in item:
-                        item["quantity"] = ""
-                    if "price" not in item:
-                        item["price"] = 0
+                    for field, default in ITEM_FIELD_DEFAULTS:
+                        item.setdefault(field, default)
 
                 # Ensure total is a number
                 try:
@@ -210,9 +370,9 @@ EMAIL CONTENT:
             return parsed_data
 
         except json.JSONDecodeError as e:
-            logger.error(f"Invalid JSON in Nova response: {str(e)}")
-            logger.error(f"Response text: {response_text}")
+            logger.error("Invalid JSON in Nova response: %s", e)
+            logger.error("Response text: %s", response_text)
             raise ValueError(f"Invalid JSON response from AI model: {str(e)}")
         except Exception as e:
-            logger.error(f"Error parsing Nova response: {str(e)}")
+            logger.error("Error parsing Nova response: %s", e)
             raise
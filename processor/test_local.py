@@ -3,19 +3,27 @@
 Local testing script for the invoice parser.
 """
 
+import hashlib
+import mmap
 import os
 import sys
 import json
-import boto3
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 
+# Commands that call AWS; boto3, the parser and .env loading are only paid for by these
+AWS_COMMANDS = ("test", "test-all")
+
 # Load environment variables from .env file
-try:
-    from dotenv import load_dotenv
-    load_dotenv()
-except ImportError:
-    print("Warning: python-dotenv not installed. Install with: pip install python-dotenv")
-    print("Using system environment variables only.")
+if sys.argv[1:2] and sys.argv[1] in AWS_COMMANDS:
+    try:
+        from dotenv import load_dotenv
+        load_dotenv()
+    except ImportError:
+        print("Warning: python-dotenv not installed. Install with: pip install python-dotenv")
+        print("Using system environment variables only.")
 
 # Add current directory to path for imports
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
@@ -25,56 +33,182 @@ AWS_REGION = os.environ.get('AWS_REGION', 'us-east-1')
 AWS_ACCESS_KEY_ID = os.environ.get('AWS_ACCESS_KEY_ID')
 AWS_SECRET_ACCESS_KEY = os.environ.get('AWS_SECRET_ACCESS_KEY')
 
-from pdf_parser import PDFParser
+# Number of PDFs parsed concurrently by test-all
+TEST_CONCURRENCY = int(os.environ.get('TEST_CONCURRENCY', '8'))
+
+# test-all appends one JSON line per PDF here as soon as it is parsed; the default sits in the
+# repository root so parsed invoice data never ends up in the Lambda package under processor/
+TEST_RESULTS_FILE = os.environ.get(
+    'TEST_RESULTS_FILE',
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'results.ndjson')
+)
+
+# Reuse successful results from the previous test-all run; set to false to re-test every PDF
+TEST_REUSE_RESULTS = os.environ.get('TEST_REUSE_RESULTS', 'true').lower() == 'true'
+
+# orjson is optional; fall back to the standard library encoder when it is not installed
+try:
+    import orjson
+
+    def dumps_json_line(obj) -> bytes:
+        """Serialize obj to a compact UTF-8 JSON line."""
+        return orjson.dumps(obj, option=orjson.OPT_APPEND_NEWLINE | orjson.OPT_NON_STR_KEYS)
+
+    def dumps_json_pretty(obj) -> str:
+        """Serialize obj to indented JSON for display."""
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS).decode('utf-8')
+except ImportError:
+    def dumps_json_line(obj) -> bytes:
+        """Serialize obj to a compact UTF-8 JSON line."""
+        return (json.dumps(obj, ensure_ascii=False) + "\n").encode('utf-8')
+
+    def dumps_json_pretty(obj) -> str:
+        """Serialize obj to indented JSON for display."""
+        return json.dumps(obj, indent=2, ensure_ascii=False)
+
+# Keeps each PDF's result block together when tests run concurrently
+print_lock = threading.Lock()
+
+# Shared boto3 session so credentials and service models are loaded once
+_SESSION = None
+
+def get_session():
+    """Return the shared boto3 session, creating it with environment credentials if available."""
+    global _SESSION
+    if _SESSION is None:
+        import boto3
+        kwargs = {
+            'region_name': AWS_REGION
+        }
+        if AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY:
+            kwargs['aws_access_key_id'] = AWS_ACCESS_KEY_ID
+            kwargs['aws_secret_access_key'] = AWS_SECRET_ACCESS_KEY
+        _SESSION = boto3.Session(**kwargs)
+    return _SESSION
 
 def create_boto3_client(service_name):
-    """Create boto3 client with environment credentials if available."""
-    kwargs = {
-        'region_name': AWS_REGION
-    }
-    if AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY:
-        kwargs['aws_access_key_id'] = AWS_ACCESS_KEY_ID
-        kwargs['aws_secret_access_key'] = AWS_SECRET_ACCESS_KEY
-    return boto3.client(service_name, **kwargs)
+    """Create boto3 client from the shared session."""
+    from botocore.config import Config
+    # PDFParser retries throttling itself, so botocore makes a single attempt; a kept-alive
+    # pool sized above the worker count lets concurrent PDFs reuse TLS connections
+    config = Config(
+        retries={'mode': 'standard', 'total_max_attempts': 1},
+        max_pool_connections=32,
+        tcp_keepalive=True,
+        connect_timeout=5,
+        read_timeout=120,
+    )
+    return get_session().client(service_name, config=config)
+
+@contextmanager
+def map_pdf(pdf_path: str):
+    """
+    Map a PDF file read-only. Empty files, which mmap cannot map, yield b"".
+    """
+    with open(pdf_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield b""
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            yield mm
+
+def file_sha256(pdf_path: str) -> str:
+    """
+    Hash a file's contents without reading it into memory in one piece.
+    """
+    with open(pdf_path, 'rb') as f:
+        return hashlib.file_digest(f, 'sha256').hexdigest()
+
+def parser_version(pdf_parser) -> dict:
+    """
+    Identify the model and prompt that produced a result, so a change invalidates reused results.
+    """
+    from pdf_parser import PROMPT_HASH
+    return {"model_id": pdf_parser.model_id, "prompt_hash": PROMPT_HASH}
+
+def load_previous_results(results_path: str, version: dict) -> dict:
+    """
+    Load successful results from an earlier test-all run with the same parser version,
+    keyed by PDF content hash.
+    """
+    previous = {}
+    try:
+        with open(results_path, 'rb') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # Line cut short by an interrupted run
+                result = entry.get("result")
+                if not entry.get("sha256") or not result:
+                    continue
+                # Results from another model or prompt say nothing about the current one
+                if any(entry.get(key) != value for key, value in version.items()):
+                    continue
+                # Failed batches come back as error entries; never replay them
+                if any('error' in invoice for invoice in result):
+                    continue
+                previous[entry["sha256"]] = result
+    except FileNotFoundError:
+        pass
+    return previous
 
-def test_single_pdf(pdf_path: str):
+def create_pdf_parser():
     """
-    Test parsing a single PDF file.
+    Create a PDFParser backed by a Bedrock client, or None if the client cannot be created.
     """
-    print(f"Testing PDF: {pdf_path}")
+    from pdf_parser import PDFParser
     
-    # Initialize AWS clients
     try:
         bedrock_client = create_boto3_client('bedrock-runtime')
     except Exception as e:
         print(f"Error initializing AWS client: {e}")
         print("Make sure you have AWS credentials configured (.env file or aws configure)")
         return None
-    
-    # Initialize parser
-    pdf_parser = PDFParser(bedrock_client)
+    return PDFParser(bedrock_client)
+
+def test_single_pdf(pdf_path: str, pdf_parser=None):
+    """
+    Test parsing a single PDF file, reusing pdf_parser when one is given.
+    """
+    if pdf_parser is None:
+        pdf_parser = create_pdf_parser()
+        if pdf_parser is None:
+            return None
     
     try:
-        # Read PDF file
-        with open(pdf_path, 'rb') as f:
-            pdf_data = f.read()
-        
-        print(f"PDF size: {len(pdf_data)} bytes")
+        # Map the PDF instead of reading it; botocore base64-encodes straight from the mapping
+        with map_pdf(pdf_path) as pdf_data:
+            pdf_size = len(pdf_data)
+            
+            filename = os.path.basename(pdf_path)
+            
+            # Parse PDF
+            result = pdf_parser.parse_invoice([(pdf_data, filename)], "")
         
-        filename = os.path.basename(pdf_path)
+        # All output for this PDF is printed as one block so pooled runs do not interleave
+        with print_lock:
+            print(f"Testing PDF: {pdf_path}")
+            print(f"PDF size: {pdf_size} bytes")
+            print("\n" + "="*50)
+            print(f"PARSING RESULT: {os.path.basename(pdf_path)}")
+            print("="*50)
+            print(dumps_json_pretty(result))
         
-        # Parse PDF
-        result = pdf_parser.parse_invoice([(pdf_data, filename)], "")
-        
-        print("\n" + "="*50)
-        print("PARSING RESULT:")
-        print("="*50)
-        print(json.dumps(result, indent=2, ensure_ascii=False))
+        # parse_invoice reports a failed Bedrock batch as {"filename", "error"} entries instead of raising
+        if any('error' in invoice for invoice in result):
+            return None
         
         return result
         
+    except FileNotFoundError:
+        with print_lock:
+            print(f"Error: File not found: {pdf_path}")
+        return None
     except Exception as e:
-        print(f"Error parsing PDF: {str(e)}")
+        with print_lock:
+            print(f"Testing PDF: {pdf_path}")
+            print(f"Error parsing PDF: {str(e)}")
         return None
 
 def test_all_sample_pdfs():
@@ -89,8 +223,12 @@ def test_all_sample_pdfs():
         print(f"Data directory not found: {data_dir}")
         return
     
-    # Find all PDF files
-    pdf_files = list(data_dir.glob("*.pdf"))
+    # Find all PDF files; DirEntry carries both the name and the path string
+    with os.scandir(data_dir) as entries:
+        pdf_files = [
+            entry for entry in entries
+            if entry.is_file() and entry.name.lower().endswith('.pdf')
+        ]
     
     if not pdf_files:
         print(f"No PDF files found in {data_dir}")
@@ -102,25 +240,64 @@ def test_all_sample_pdfs():
     
     print("\n" + "="*70)
     
-    results = {}
+    # One client is shared by all workers; boto3 clients are thread-safe
+    pdf_parser = create_pdf_parser()
+    if pdf_parser is None:
+        return
     
+    # Identical PDFs are parsed once; results from the previous run are reused by content hash
+    digests = {pdf_file.name: file_sha256(pdf_file.path) for pdf_file in pdf_files}
+    version = parser_version(pdf_parser)
+    parsed = load_previous_results(TEST_RESULTS_FILE, version) if TEST_REUSE_RESULTS else {}
+    pdfs_to_parse = {}
     for pdf_file in pdf_files:
-        print(f"\nTesting: {pdf_file.name}")
-        print("-" * 50)
+        digest = digests[pdf_file.name]
+        if digest not in parsed and digest not in pdfs_to_parse:
+            pdfs_to_parse[digest] = pdf_file
+    
+    # Only success flags are kept in memory; full results are streamed to the results file
+    results = {}
+    
+    with open(TEST_RESULTS_FILE, 'wb') as results_file:
+        def record_result(filename, result):
+            digest = digests[filename]
+            parsed[digest] = result
+            results_file.write(dumps_json_line(
+                {"name": filename, "sha256": digest, **version, "result": result}
+            ))
+            results_file.flush()
+            results[filename] = bool(result)
+        
+        # Write reused results back first so an interrupted rerun does not lose them
+        for pdf_file in pdf_files:
+            if digests[pdf_file.name] in parsed:
+                print(f"Reusing result for {pdf_file.name} (already parsed in the previous run)")
+                record_result(pdf_file.name, parsed[digests[pdf_file.name]])
         
-        result = test_single_pdf(str(pdf_file))
-        results[pdf_file.name] = result
+        with ThreadPoolExecutor(max_workers=TEST_CONCURRENCY) as executor:
+            futures = {
+                executor.submit(test_single_pdf, pdf_file.path, pdf_parser): pdf_file.name
+                for pdf_file in pdfs_to_parse.values()
+            }
+            for future in as_completed(futures):
+                record_result(futures[future], future.result())
         
-        print("\n" + "="*70)
+        for pdf_file in pdf_files:
+            if pdf_file.name not in results:
+                print(f"Reusing result for {pdf_file.name} (same content as another PDF)")
+                record_result(pdf_file.name, parsed[digests[pdf_file.name]])
     
     # Summary
+    print("\n" + "="*70)
     print("\nSUMMARY:")
     print("="*70)
     
-    for filename, result in results.items():
-        status = "✓ SUCCESS" if result else "✗ FAILED"
+    for filename in (pdf_file.name for pdf_file in pdf_files):
+        status = "✓ SUCCESS" if results[filename] else "✗ FAILED"
         print(f"{filename}: {status}")
     
+    print(f"\nResults written to {TEST_RESULTS_FILE}")
+    
     return results
 
 def show_pdf_info(pdf_path: str):
@@ -130,18 +307,51 @@ def show_pdf_info(pdf_path: str):
     print(f"Analyzing PDF: {pdf_path}")
     
     try:
-        with open(pdf_path, 'rb') as f:
-            pdf_data = f.read()
-        
-        print("\n" + "="*50)
-        print("PDF INFORMATION:")
-        print("="*50)
-        print(f"File size: {len(pdf_data)} bytes")
-        print(f"File path: {pdf_path}")
-        print("Note: PDF content will be sent directly to AWS Bedrock Nova for parsing")
-        
-    except Exception as e:
-        print(f"Error reading PDF: {str(e)}")
+        file_size = os.stat(pdf_path).st_size
+    except FileNotFoundError:
+        print(f"Error: File not found: {pdf_path}")
+        return
+    
+    print("\n" + "="*50)
+    print("PDF INFORMATION:")
+    print("="*50)
+    print(f"File size: {file_size} bytes")
+    print(f"File path: {pdf_path}")
+    print("Note: PDF content will be sent directly to AWS Bedrock Nova for parsing")
+
+def _pdf_path_arg(args):
+    """
+    Return the PDF path argument, or None after printing an error if it is missing.
+    """
+    if not args:
+        print("Error: Please provide PDF file path")
+        return None
+    return args[0]
+
+def _do_test(args):
+    """Handle `test <pdf_path>`."""
+    pdf_path = _pdf_path_arg(args)
+    if pdf_path is None:
+        return
+    test_single_pdf(pdf_path)
+
+def _do_test_all(args):
+    """Handle `test-all`."""
+    test_all_sample_pdfs()
+
+def _do_info(args):
+    """Handle `info <pdf_path>`."""
+    pdf_path = _pdf_path_arg(args)
+    if pdf_path is None:
+        return
+    show_pdf_info(pdf_path)
+
+# Command name -> handler taking the remaining arguments; handlers import what they need
+COMMANDS = {
+    'test': _do_test,
+    'test-all': _do_test_all,
+    'info': _do_info,
+}
 
 def main():
     """
@@ -161,32 +371,11 @@ def main():
         return
     
     command = sys.argv[1]
-    
-    if command == "test":
-        if len(sys.argv) < 3:
-            print("Error: Please provide PDF file path")
-            return
-        pdf_path = sys.argv[2]
-        if not os.path.exists(pdf_path):
-            print(f"Error: File not found: {pdf_path}")
-            return
-        test_single_pdf(pdf_path)
-    
-    elif command == "test-all":
-        test_all_sample_pdfs()
-    
-    elif command == "info":
-        if len(sys.argv) < 3:
-            print("Error: Please provide PDF file path")
-            return
-        pdf_path = sys.argv[2]
-        if not os.path.exists(pdf_path):
-            print(f"Error: File not found: {pdf_path}")
-            return
-        show_pdf_info(pdf_path)
-    
-    else:
+    handler = COMMANDS.get(command)
+    if handler is None:
         print(f"Unknown command: {command}")
+        return
+    handler(sys.argv[2:])
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,127 @@
+import logging
+import random
+import threading
+import time
+
+from botocore.exceptions import ClientError, ConnectionError, HTTPClientError
+
+logger = logging.getLogger(__name__)
+
+THROTTLING_ERROR_CODES = {
+    "Throttling",
+    "ThrottlingException",
+    "TooManyRequestsException",
+    "RequestLimitExceeded",
+}
+
+# Transient service-side failures, retried like throttling (mirrors botocore standard mode)
+TRANSIENT_ERROR_CODES = {
+    "InternalFailure",
+    "InternalServerException",
+    "ModelNotReadyException",
+    "PriorRequestNotComplete",
+    "RequestTimeout",
+    "RequestTimeoutException",
+    "ServiceUnavailable",
+    "ServiceUnavailableException",
+}
+
+# Connection-level failures: failed connects, dropped pooled connections and read timeouts
+CONNECTION_ERRORS = (ConnectionError, HTTPClientError)
+
+
+class RateLimiter:
+    """
+    Caps concurrent in-flight calls and spaces call starts to a maximum rate.
+
+    Use as a context manager around each throttled call:
+
+        with limiter:
+            client.call(...)
+    """
+
+    def __init__(self, max_inflight: int, rps: float):
+        self._semaphore = threading.Semaphore(max_inflight)
+        self._lock = threading.Lock()
+        self._interval = 1.0 / rps if rps > 0 else 0.0
+        self._next_allowed_ts = 0.0
+
+    def acquire(self):
+        self._semaphore.acquire()
+        try:
+            # Reserve the next start slot under the lock, then sleep outside it
+            with self._lock:
+                now = time.monotonic()
+                start_ts = max(now, self._next_allowed_ts)
+                self._next_allowed_ts = start_ts + self._interval
+            delay = start_ts - now
+            if delay > 0:
+                logger.debug("Rate limiter delaying call by %.3fs", delay)
+                time.sleep(delay)
+        except BaseException:
+            self._semaphore.release()
+            raise
+
+    def release(self):
+        self._semaphore.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+def is_throttling_error(error: ClientError) -> bool:
+    """
+    Check whether a ClientError is a throttling / quota error worth retrying.
+    """
+    response = error.response or {}
+    code = response.get("Error", {}).get("Code", "")
+    status = response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+    message = response.get("Error", {}).get("Message", "").lower()
+
+    return (
+        code in THROTTLING_ERROR_CODES
+        or status == 429
+        or "rate exceeded" in message
+        or "rate limit" in message
+        or "quota" in message
+    )
+
+
+def is_retryable_error(error: Exception) -> bool:
+    """
+    Check whether an error is throttling, a transient service error or a connection failure.
+    """
+    if isinstance(error, CONNECTION_ERRORS):
+        return True
+    if not isinstance(error, ClientError):
+        return False
+    response = error.response or {}
+    code = response.get("Error", {}).get("Code", "")
+    status = response.get("ResponseMetadata", {}).get("HTTPStatusCode") or 0
+    return is_throttling_error(error) or code in TRANSIENT_ERROR_CODES or status >= 500
+
+
+def retry_throttle(fn, *args, attempts: int = 3, base: float = 0.5, cap: float = 8.0, **kwargs):
+    """
+    Call fn(*args, **kwargs), retrying throttling and transient errors with exponential backoff.
+
+    This is the only retry layer for the calls it wraps: their clients are created with
+    botocore retries disabled. Any other error, or a retryable error on the last attempt,
+    is re-raised.
+    """
+    for attempt in range(attempts):
+        try:
+            return fn(*args, **kwargs)
+        except (ClientError, *CONNECTION_ERRORS) as e:
+            if attempt == attempts - 1 or not is_retryable_error(e):
+                raise
+            delay = min(cap, base * 2 ** attempt) + random.uniform(0, 0.25)
+            logger.warning(
+                "Retryable error calling %s (attempt %d/%d), retrying in %.2fs: %s",
+                getattr(fn, '__name__', fn), attempt + 1, attempts, delay, e,
+            )
+            time.sleep(delay)